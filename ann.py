@@ -0,0 +1,71 @@
+import numpy as np
+
+
+def pca(m, dims, samples=10000, rng=np.random):
+    if len(m) > samples:
+        m = m[np.sort(rng.choice(len(m), samples, replace=False))]
+    mean = m.mean(0)
+    _, _, vt = np.linalg.svd(m - mean, full_matrices=False)
+    return mean, vt[:dims]
+
+
+def nearest(x, centroids, chunk=10000):
+    # index of the closest centroid to each row of x
+    sq = (centroids * centroids).sum(1)
+    labels = np.empty(len(x), dtype=int)
+    for i in range(0, len(x), chunk):
+        labels[i:i + chunk] = (2 * x[i:i + chunk].dot(centroids.T) -
+                               sq).argmax(1)
+    return labels
+
+
+def kmeans(x, k, iterations=10, rng=np.random):
+    centroids = x[rng.choice(len(x), k, replace=False)]
+    for _ in range(iterations):
+        labels = nearest(x, centroids)
+        sizes = np.bincount(labels, minlength=k)
+        sums = np.column_stack([np.bincount(labels, x[:, j], minlength=k)
+                                for j in range(x.shape[1])])
+        full = sizes > 0
+        centroids[full] = sums[full] / sizes[full, None]
+    return centroids
+
+
+class IVFIndex(object):
+    # inverted file over PCA-reduced unit vectors: rows are clustered, and
+    # every row of a query's nprobe nearest clusters is scored exactly
+    def __init__(self, m, nlist=None, dims=64, seed=0, iterations=10):
+        rng = np.random.RandomState(seed)
+        m = np.asarray(m)
+        if nlist is None:
+            nlist = max(1, int(len(m)**0.5))
+        self.mean, self.components = pca(m, dims, rng=rng)
+        train = m
+        if len(m) > 50 * nlist:
+            train = m[np.sort(rng.choice(len(m), 50 * nlist, replace=False))]
+        self.centroids = kmeans(self.reduce(train), nlist, iterations, rng)
+        labels = nearest(self.reduce(m), self.centroids)
+        self.order = np.argsort(labels, kind='stable')
+        self.starts = np.concatenate(
+            ([0], np.cumsum(np.bincount(labels, minlength=nlist))))
+        self.vectors = np.asarray(m[self.order], dtype=np.float32)
+
+    def reduce(self, x):
+        return (x - self.mean).dot(self.components.T)
+
+    def probes(self, q, nprobe):
+        d = self.centroids - self.reduce(q)
+        d = (d * d).sum(1)
+        if nprobe >= len(d):
+            return np.arange(len(d))
+        return np.argpartition(d, nprobe - 1)[:nprobe]
+
+    def search(self, q, nprobe=8):
+        # the rows of the probed clusters and their cosine similarity to q
+        q = np.asarray(q, dtype=float) / np.dot(q, q)**0.5
+        q32 = q.astype(np.float32)
+        slices = [slice(self.starts[c], self.starts[c + 1])
+                  for c in np.sort(self.probes(q, nprobe))]
+        rows = np.concatenate([np.arange(s.start, s.stop) for s in slices])
+        scores = np.concatenate([self.vectors[s].dot(q32) for s in slices])
+        return self.order[rows], scores.astype(float)
@@ -0,0 +1,187 @@
+import argparse
+import copy
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import vectors
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def synthetic_words(nwords=300, dim=300, seed=0):
+    # stand-in word lists and vectors, so no spaCy model is needed
+    rng = np.random.RandomState(seed)
+    wordlists = []
+    for form, filename in vectors.wordfiles:
+        words = ["%s%d" % (form, i) for i in range(nwords)]
+        with open(filename, "w") as f:
+            f.write("\n".join(words) + "\n")
+        wordlists.append((form, words))
+    vectors.save(wordlists, rng.randn(len(wordlists) * nwords, dim))
+
+
+def stages(pdf=False):
+    import grammar
+    import language
+    import poem
+    import script
+    import translation
+
+    grammar.grammarfile = os.path.join(here, "grammar.json")
+    grammar.snapshotfile = os.path.abspath("grammar.pickle")
+    initial = copy.deepcopy(translation.getstate())
+    state = {}
+
+    def words(n):
+        l = language.Language(phonemes={'V': 'AEIOU', 'C': 'PTKMSL'},
+                              syll='CV', wordlength=(3, 6))
+        for _ in range(10 * n):
+            l.word("noun")
+        return 10 * n
+
+    def names(n):
+        language.get_language().names("city", n)
+        return n
+
+    def getword(n):
+        for sense in np.random.randn(10 * n, 300):
+            translation.getword(sense, "noun")
+        return 10 * n
+
+    def poems(n):
+        translation.setstate(copy.deepcopy(initial))
+        state["poems"] = [poem.Poem(3 + i % 7) for i in range(n)]
+        return n
+
+    def gloss(n):
+        for p in state["poems"]:
+            p.gloss()
+        return n
+
+    def render(n):
+        state["svgs"] = [script.renderpoem(p.lines) for p in state["poems"]]
+        return n
+
+    def serialize(n):
+        for s in state["svgs"]:
+            str(s)
+        return n
+
+    def savepdf(n):
+        for s in state["svgs"]:
+            s.savepdf("bench.pdf")
+        return n
+
+    def expand(n):
+        for _ in range(n):
+            grammar.lookup("pieceintro")
+        return n
+
+    result = [("language.word", words), ("language.name", names),
+              ("translation.getword", getword), ("poem.Poem", poems),
+              ("poem.gloss", gloss), ("script.renderpoem", render),
+              ("svg.str", serialize)]
+    if pdf:
+        result.append(("svg.savepdf", savepdf))
+    result.append(("grammar.lookup", expand))
+    return result
+
+
+def measure(f, n, memory):
+    random.seed(0)
+    np.random.seed(0)
+    if memory:
+        tracemalloc.start()
+    t = time.perf_counter()
+    items = f(n)
+    elapsed = time.perf_counter() - t
+    peak = 0
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return items, elapsed, peak
+
+
+def run(sizes, pdf=False, memory=True):
+    results = {}
+    benches = stages(pdf)
+    # lazy imports and file loads happen here rather than in the timings
+    for name, f in benches:
+        measure(f, 1, False)
+    for n in sizes:
+        for name, f in benches:
+            items, elapsed, _ = measure(f, n, False)
+            peak = measure(f, n, True)[2] if memory else 0
+            results["%s/%d" % (name, n)] = {
+                "items": items, "seconds": elapsed, "peak": peak}
+            print("%-20s %6d %8d items %9.4fs %12.1f/s %10.1f KiB" % (
+                name, n, items, elapsed, items / max(elapsed, 1e-9),
+                peak / 1024.))
+            sys.stdout.flush()
+    return results
+
+
+def compare(results, baseline, threshold):
+    regressions = 0
+    for key, r in sorted(results.items()):
+        if key not in baseline:
+            continue
+        b = baseline[key]
+        ratio = ((r["seconds"] / r["items"]) /
+                 max(b["seconds"] / b["items"], 1e-12))
+        flag = ""
+        if ratio > threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        memory = "-"
+        if r["peak"] and b["peak"]:
+            memory = "%.2fx" % (r["peak"] / b["peak"])
+        print("%-28s %7.2fx time %7s memory%s" % (key, ratio, memory, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="1,10,100,1000,10000",
+                        help="comma-separated numbers of poems")
+    parser.add_argument("--pdf", action="store_true",
+                        help="also time cairosvg PDF conversion")
+    parser.add_argument("--no-memory", dest="memory", action="store_false",
+                        help="skip the tracemalloc pass")
+    parser.add_argument("--save", help="write the results as JSON")
+    parser.add_argument("--compare", help="JSON results to compare against")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="slowdown per item reported as a regression")
+    args = parser.parse_args()
+    sizes = [int(n) for n in args.sizes.split(",")]
+
+    baseline = None
+    if args.compare:
+        baseline = json.load(open(args.compare))
+    if args.save:
+        args.save = os.path.abspath(args.save)
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            synthetic_words()
+            results = run(sizes, args.pdf, args.memory)
+        finally:
+            os.chdir(cwd)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if baseline is not None:
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
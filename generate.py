@@ -6,12 +6,24 @@ import script
 import grammar
 import translation
 import poem
+import svg
+import stats
+import argparse
+import filecmp
+import hashlib
+import io
+import multiprocessing
+import os
+import pickle
+import queue
 import re
-import sys
+import shutil
+import threading
+import time
 
 
-npoems = int(sys.argv[1])
 vocabsofar = set()
+meanings = 0
 
 
 def fixfootnotes(text):
@@ -30,61 +42,461 @@ def fixfootnotes(text):
 def linecount(pos):
     return sum(random.random() < pos for _ in range(6)) + 3
 
-meanings = 0
 
-print("Generating %d poems" % npoems)
-with open("book/poems.tex", "w") as tex:
-    for i in range(npoems):
-        nlines = linecount(i / npoems)
-        print("Generating poem %d with %d lines" % (i+1, nlines))
+def reseed(*keys):
+    random.seed(":".join(str(k) for k in keys))
+
+
+pagefiles = {"poem": "book/poempages.pdf", "glyph": "book/glyphpages.pdf"}
+checkpointfile = "book/checkpoint.pickle"
+
+
+def build(job):
+    seed, kind, arg, filename = job
+    state = random.getstate()
+    reseed(seed, filename)
+    try:
+        stats.count("build." + kind)
+        if kind == "poem":
+            return script.renderpoem(arg)
+        else:
+            return script.renderglyph(arg)
+    finally:
+        random.setstate(state)
+
+
+def codeversion():
+    h = hashlib.sha1()
+    for filename in ("script.py", "svg.py", "geom.py"):
+        h.update(open(filename, "rb").read())
+    return h.hexdigest()
+
+
+def cachepath(cachedir, version, *inputs):
+    # one subdirectory per code version, so stale ones can be pruned whole
+    if cachedir is None:
+        return None
+    key = hashlib.sha1(repr(inputs).encode("utf8")).hexdigest()
+    return os.path.join(cachedir, version[:16], key + ".pdf")
+
+
+def prunecache(cachedir, version):
+    for name in os.listdir(cachedir):
+        path = os.path.join(cachedir, name)
+        if name != version[:16] and os.path.isdir(path) and \
+                re.match(r"[0-9a-f]{16}$", name):
+            shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(os.path.join(cachedir, version[:16]), exist_ok=True)
+
+
+def replacewith(filename, write):
+    # files in book/ may be hard links into the cache, so never write
+    # them in place
+    tmp = "%s.%d.tmp" % (filename, os.getpid())
+    write(tmp)
+    os.replace(tmp, filename)
+
+
+def linkfile(source, filename):
+    def write(tmp):
+        try:
+            os.link(source, tmp)
+        except OSError:
+            shutil.copyfile(source, tmp)
+
+    replacewith(filename, write)
+
+
+def produce(filename, cached, write):
+    if cached is None:
+        replacewith(filename, write)
+        return True
+    rendered = not os.path.exists(cached)
+    stats.count("cache.miss" if rendered else "cache.hit")
+    if rendered:
+        replacewith(cached, write)
+    if not (os.path.exists(filename) and
+            (os.path.samefile(cached, filename) or
+             filecmp.cmp(cached, filename, shallow=False))):
+        linkfile(cached, filename)
+    return rendered
+
+
+def writeifchanged(filename, text):
+    if os.path.exists(filename) and open(filename).read() == text:
+        return
+    with open(filename, "w") as f:
+        f.write(text)
+
+
+def chunkfile(n):
+    return "book/poems-%04d.tex" % n
+
+
+def savecheckpoint(filename, args, nextpoem):
+    state = {"args": (args.npoems, args.seed, args.chunk),
+             "next": nextpoem,
+             "vocabsofar": vocabsofar,
+             "meanings": meanings,
+             "grammar": grammar.context.used,
+             "translation": translation.getstate()}
+    tmp = "%s.%d.tmp" % (filename, os.getpid())
+    with open(tmp, "wb") as f:
+        pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, filename)
+
+
+def loadcheckpoint(filename, args):
+    global vocabsofar, meanings
+    with open(filename, "rb") as f:
+        state = pickle.load(f)
+    if state["args"] != (args.npoems, args.seed, args.chunk):
+        raise ValueError("%s was written for npoems=%d seed=%d chunk=%d" %
+                         ((filename,) + state["args"]))
+    vocabsofar = state["vocabsofar"]
+    meanings = state["meanings"]
+    grammar.context.used = state["grammar"]
+    translation.setstate(state["translation"])
+    return state["next"]
+
+
+def render(job, direct=False, cached=None):
+    def write(filename):
+        with stats.timer("svg.build"):
+            element = build(job)
+        element.savepdf(filename, direct)
+
+    return produce(job[-1], cached, write)
+
+
+def render_isolated(job, direct=False, cached=None):
+    return stats.isolated(render, job, direct, cached)
+
+
+def writepoem(tex, i, npoems, seed, submit):
+    reseed(seed, "poem", i)
+    nlines = linecount(i / npoems)
+    print("Generating poem %d with %d lines" % (i+1, nlines))
+    row = stats.begin(poem=i + 1, lines=nlines)
+    with stats.timer("writepoem"):
+        writechapter(tex, i, nlines, seed, submit)
+    stats.end()
+    return row
+
+
+def writechapter(tex, i, nlines, seed, submit):
+    global vocabsofar, meanings
+    with stats.timer("poem.build"):
         p = poem.Poem(nlines)
-        vocab = set(p.words)
-        newvocab = vocab - vocabsofar
-        vocabsofar |= vocab
-        tex.write("\\chapter{%s}\n\n" % grammar.flatten("#poemtitle#"))
-
-        s = script.renderpoem(p.lines)
-        filename = "book/poem%02d.pdf" % i
-        s.savepdf(filename)
-        tex.write("\\begin{center}\n"
-                  "\\includegraphics[scale=0.8]{%s}\n\\end{center}\n\n" %
-                  filename)
-
-        tex.write(grammar.lookup("pieceintro") + "\n\n")
-        tex.write("\\section{Transcription}\n")
-
-        for line in p.lines:
-            tex.write(" ".join(line) + "\\\\\n")
-        tex.write("\n\n")
-
-        tex.write("\\section{Gloss}\n\n")
+    vocab = set(p.words)
+    newvocab = vocab - vocabsofar
+    vocabsofar |= vocab
+    tex.write("\\chapter{%s}\n\n" % grammar.flatten("#poemtitle#"))
+
+    filename = "book/poem%02d.pdf" % i
+    tex.write("\\begin{center}\n"
+              "\\includegraphics%s\n\\end{center}\n\n" %
+              submit((seed, "poem", p.lines, filename)))
+
+    tex.write(grammar.lookup("pieceintro") + "\n\n")
+    tex.write("\\section{Transcription}\n")
+
+    for line in p.lines:
+        tex.write(" ".join(line) + "\\\\\n")
+    tex.write("\n\n")
+
+    tex.write("\\section{Gloss}\n\n")
+    with stats.timer("poem.gloss"):
         gloss = [g if g else "[...]" for g in p.gloss()]
-        tex.write(" ".join(gloss) + "\n\n")
+    tex.write(" ".join(gloss) + "\n\n")
 
-        if newvocab:
-            tex.write("\section{Vocabulary}\n\n")
-            for w in sorted(newvocab):
-                filename = "book/%s.pdf" % w
-                script.renderglyph(w).savepdf(filename)
-                tex.write("\\noindent\\parbox{0.18\\textwidth}"
-                          "{\\includegraphics[scale=0.8]{%s}}\n" % filename)
+    if newvocab:
+        tex.write("\section{Vocabulary}\n\n")
+        for w in sorted(newvocab):
+            filename = "book/%s.pdf" % w
+            tex.write("\\noindent\\parbox{0.18\\textwidth}"
+                      "{\\includegraphics%s}\n" %
+                      submit((seed, "glyph", w, filename)))
 
+            with stats.timer("translation.gloss"):
                 readings = translation.gloss(w)
-                random.shuffle(readings)
-                trans = ''
-                for reading in readings:
-                    if not trans:
-                        trans = grammar.lookup("gloss1", reading=reading,
-                                also="")
-                    else:
-                        trans += ' ' + grammar.lookup(
-                            "gloss2", reading=reading, also=" also")
-                if not readings:
-                    trans = "The correct reading of this glyph is unknown."
+            random.shuffle(readings)
+            trans = ''
+            for reading in readings:
+                if not trans:
+                    trans = grammar.lookup("gloss1", reading=reading,
+                                           also="")
                 else:
-                    meanings += 1
-                tex.write(
-                    fixfootnotes("\\parbox{0.8\\textwidth}{\\emph{%s} %s}" % (
-                        w, trans)) + "\\vspace{1em}\n\n")
+                    trans += ' ' + grammar.lookup(
+                        "gloss2", reading=reading, also=" also")
+            if not readings:
+                trans = "The correct reading of this glyph is unknown."
+            else:
+                meanings += 1
+            tex.write(
+                fixfootnotes("\\parbox{0.8\\textwidth}{\\emph{%s} %s}" % (
+                    w, trans)) + "\\vspace{1em}\n\n")
+
+
+class Stage(threading.Thread):
+    # applies f to each item from inq in turn and passes the results to outq,
+    # keeping count of time spent working, waiting for input and blocked on
+    # a full outq
+    def __init__(self, name, f, inq, outq=None):
+        threading.Thread.__init__(self, name=name, daemon=True)
+        self.f = f
+        self.inq = inq
+        self.outq = outq
+        self.error = None
+        self.busy = self.waiting = self.blocked = 0.
+        self.depths = []
+
+    def put(self, item):
+        t = time.perf_counter()
+        self.outq.put(item)
+        self.blocked += time.perf_counter() - t
+
+    def run(self):
+        try:
+            while True:
+                self.depths.append(self.inq.qsize())
+                t = time.perf_counter()
+                item = self.inq.get()
+                self.waiting += time.perf_counter() - t
+                if item is None:
+                    break
+                t = time.perf_counter()
+                result = self.f(item)
+                self.busy += time.perf_counter() - t
+                if self.outq is not None:
+                    self.put(result)
+        except BaseException as e:
+            self.error = e
+            # keep consuming so that earlier stages never block
+            while self.inq.get() is not None:
+                pass
+        finally:
+            if self.outq is not None:
+                self.outq.put(None)
+
+
+def pipeline(args, version, done, filename="book/poems.tex"):
+    # generation, SVG building, PDF conversion and tex writing run as
+    # threads joined by bounded queues; both generation and SVG building
+    # use the global random state, so they take turns
+    randomlock = threading.Lock()
+
+    def lockedbuild(job):
+        with randomlock:
+            with stats.timer("svg.build"):
+                return build(job)
+
+    def buildsvgs(item):
+        text, row, jobs = item
+        stats.setrow(row)
+        built = []
+        for job in jobs:
+            cached = cachepath(args.cache, version, args.direct, job)
+            element = None
+            if cached is None or not os.path.exists(cached):
+                element = lockedbuild(job)
+            built.append((job, cached, element))
+        return text, row, built
+
+    def convert(item):
+        text, row, built = item
+        stats.setrow(row)
+        for job, cached, element in built:
+            def write(filename, job=job, element=element):
+                if element is None:
+                    element = lockedbuild(job)
+                element.savepdf(filename, args.direct)
+
+            done(produce(job[-1], cached, write))
+        return text
+
+    tmp = "%s.%d.tmp" % (filename, os.getpid())
+    out = open(tmp, "w")
+    queues = [queue.Queue(args.pipeline) for _ in range(3)]
+    generator = Stage("generate", None, None, queues[0])
+    stages = [Stage("build", buildsvgs, queues[0], queues[1]),
+              Stage("convert", convert, queues[1], queues[2]),
+              Stage("write", out.write, queues[2])]
+    for stage in stages:
+        stage.start()
+    finished = False
+    try:
+        for i in range(args.npoems):
+            if any(stage.error is not None for stage in stages):
+                break
+            jobs = []
+
+            def submit(job):
+                jobs.append(job)
+                return "[scale=0.8]{%s}" % job[-1]
+
+            tex = io.StringIO()
+            t = time.perf_counter()
+            with randomlock:
+                row = writepoem(tex, i, args.npoems, args.seed, submit)
+            generator.busy += time.perf_counter() - t
+            generator.depths.append(queues[0].qsize())
+            generator.put((tex.getvalue(), row, jobs))
+        finished = True
+    finally:
+        queues[0].put(None)
+        for stage in stages:
+            stage.join()
+        out.close()
+        errors = [stage.error for stage in stages if stage.error is not None]
+        if errors or not finished:
+            os.remove(tmp)
+    if errors:
+        raise errors[0]
+    if os.path.exists(filename) and filecmp.cmp(tmp, filename, shallow=False):
+        os.remove(tmp)
+    else:
+        os.replace(tmp, filename)
+
+    print("%-10s %9s %9s %9s %11s" % ("stage", "busy", "waiting", "blocked",
+                                       "queue mean/max"))
+    for stage in [generator] + stages:
+        depths = stage.depths or [0]
+        print("%-10s %8.2fs %8.2fs %8.2fs %7.1f/%d" % (
+            stage.name, stage.busy, stage.waiting, stage.blocked,
+            sum(depths) / float(len(depths)), max(depths)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("npoems", type=int)
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="number of processes rendering PDFs")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--direct", action="store_true",
+                        help="draw PDFs with cairo instead of via SVG text")
+    parser.add_argument("--multipage", action="store_true",
+                        help="write all poems and all glyphs as pages of "
+                        "two PDFs")
+    parser.add_argument("--cache",
+                        help="keep rendered PDFs in this directory and reuse "
+                        "them; entries from other versions of the rendering "
+                        "code are deleted")
+    parser.add_argument("--no-cache", dest="cache", action="store_const",
+                        const=None)
+    parser.add_argument("--chunk", type=int, default=0,
+                        help="write this many chapters per .tex file and "
+                        "checkpoint after each file")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue from the last checkpoint")
+    parser.add_argument("--lexicon",
+                        help="reuse readings saved in this file by an "
+                        "earlier run, and save this run's lexicon there")
+    parser.add_argument("--pipeline", type=int, default=0, metavar="N",
+                        help="generate, build SVGs, convert to PDF and write "
+                        "tex in concurrent stages joined by queues of size N")
+    parser.add_argument("--stats",
+                        help="time each stage and write a per-poem report "
+                        "to this .json or .csv file")
+    args = parser.parse_args()
+    if args.chunk and args.multipage:
+        parser.error("--chunk cannot be combined with --multipage")
+    if args.resume and not args.chunk:
+        parser.error("--resume needs --chunk")
+    if args.pipeline and (args.chunk or args.multipage or args.jobs > 1):
+        parser.error("--pipeline cannot be combined with --chunk, "
+                     "--multipage or --jobs")
+
+    stats.enable(args.stats is not None)
+    version = codeversion()
+    if args.cache is not None:
+        os.makedirs(args.cache, exist_ok=True)
+        prunecache(args.cache, version)
+    rendered = [0, 0]
+
+    def done(r):
+        rendered[0] += r
+        rendered[1] += 1
+
+    pool = None
+    if args.jobs > 1 and not args.multipage:
+        pool = multiprocessing.Pool(args.jobs, stats.enable,
+                                    (stats.enabled,))
+    pending = []
+    pages = {"poem": [], "glyph": []}
+
+    def submit(job):
+        _, kind, _, filename = job
+        if args.multipage:
+            pages[kind].append(job)
+            return "[scale=0.8,page=%d]{%s}" % (len(pages[kind]),
+                                                pagefiles[kind])
+        cached = cachepath(args.cache, version, args.direct, job)
+        if pool is None:
+            done(render(job, args.direct, cached))
+        else:
+            f = render_isolated if stats.enabled else render
+            pending.append((pool.apply_async(f, (job, args.direct, cached)),
+                            stats.currentrow()))
+        return "[scale=0.8]{%s}" % filename
+
+    def drain():
+        for r, row in pending:
+            result = r.get()
+            if stats.enabled:
+                result, snap = result
+                stats.merge(snap, row)
+            done(result)
+        del pending[:]
+
+    print("Generating %d poems" % args.npoems)
+    start = 0
+    if args.resume and os.path.exists(checkpointfile):
+        start = loadcheckpoint(checkpointfile, args)
+        print("Resuming at poem %d" % (start + 1))
+    if args.lexicon and os.path.exists(args.lexicon):
+        translation.lexicon.reuse(translation.loadlexicon(args.lexicon))
+    if args.pipeline:
+        pipeline(args, version, done)
+    elif args.chunk:
+        for first in range(start, args.npoems, args.chunk):
+            last = min(first + args.chunk, args.npoems)
+            with open(chunkfile(first // args.chunk), "w") as tex:
+                for i in range(first, last):
+                    writepoem(tex, i, args.npoems, args.seed, submit)
+                    tex.flush()
+            drain()
+            writeifchanged("book/poems.tex", "".join(
+                "\\input{%s}\n" % chunkfile(n)
+                for n in range(first // args.chunk + 1)))
+            savecheckpoint(checkpointfile, args, last)
+    else:
+        tex = io.StringIO()
+        for i in range(args.npoems):
+            writepoem(tex, i, args.npoems, args.seed, submit)
+        writeifchanged("book/poems.tex", tex.getvalue())
+
+    drain()
+    if pool is not None:
+        pool.close()
+        pool.join()
+    for kind, jobs in pages.items():
+        if jobs:
+            done(produce(
+                pagefiles[kind], cachepath(args.cache, version, jobs),
+                lambda filename: svg.savepdfs((build(job) for job in jobs),
+                                              filename)))
+
+    print("Rendered %d of %d PDFs" % tuple(rendered))
+
+    print("%d vocab items, %d with definitions" % (len(vocabsofar), meanings))
+
+    if args.lexicon:
+        translation.lexicon.save(args.lexicon)
+    if args.stats:
+        stats.report(args.stats)
+        print(stats.summary())
+
 
-print("%d vocab items, %d with definitions" % (len(vocabsofar), meanings))
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,7 @@
-from collections import namedtuple
+from collections import defaultdict, namedtuple
+import heapq
+import math
+import numpy as np
 import random
 
 
@@ -124,45 +127,197 @@ def is_convex(poly):
     return True
 
 
+def convex_hull(points):
+    pts = sorted(set(Point(*p) for p in points))
+    if len(pts) <= 2:
+        return pts
+
+    def chain(pts):
+        hull = []
+        for p in pts:
+            while len(hull) >= 2 and signed_area(hull[-2], hull[-1], p) <= 0:
+                hull.pop()
+            hull.append(p)
+        return hull[:-1]
+
+    return chain(pts) + chain(reversed(pts))
+
+
 def obb(poly):
     hull = convex_hull(poly)
-    axes = [normalize(hull[i] - hull[i - 1]) for i in range(len(hull))]
-    boxes = []
-    for axis in axes:
+    n = len(hull)
+    if n == 1:
+        p = hull[0]
+        return OrientedBox(Point(1, 0), p.x, p.x, p.y, p.y)
+
+    def advance(j, axis, sign):
+        for _ in range(n):
+            k = (j + 1) % n
+            if sign * dot(hull[k], axis) < sign * dot(hull[j], axis):
+                break
+            j = k
+        return j
+
+    best = None
+    for i in range(n):
+        axis = normalize(hull[i] - hull[i - 1])
         aperp = axis.perp()
-        l = min(dot(p, axis) for p in hull)
-        r = max(dot(p, axis) for p in hull)
-        t = max(dot(p, aperp) for p in hull)
-        b = min(dot(p, aperp) for p in hull)
-        box = OrientedBox(axis, l, r, t, b)
-        boxes.append(box)
-    return min(boxes, key=lambda b: b.area)
-
-
-def simplifypoly(poly):
-    nxt = dict([(poly[i - 1], poly[i]) for i in range(len(poly))])
-    prv = dict([(poly[i], poly[i - 1]) for i in range(len(poly))])
-
-    changed = True
-    while changed:
-        changed = False
-        pts = nxt.keys()
-        for pt in pts:
-            p = prv[pt]
-            n = nxt[pt]
-            dy = normalize(n - p).perp()
-            if abs(dot(pt - p, dy)) < 1e-2:
-                del prv[pt]
-                del nxt[pt]
-                prv[n] = p
-                nxt[p] = n
-                changed = True
-    p, n = nxt.popitem()
-    newpoly = [p]
-    while n in nxt:
-        p, n = n, nxt[n]
-        newpoly.append(p)
-    return newpoly
+        if best is None:
+            r = max(range(n), key=lambda j: dot(hull[j], axis))
+            l = min(range(n), key=lambda j: dot(hull[j], axis))
+            t = max(range(n), key=lambda j: dot(hull[j], aperp))
+        r = advance(r, axis, 1)
+        l = advance(l, axis, -1)
+        t = advance(t, aperp, 1)
+        box = OrientedBox(axis, dot(hull[l], axis), dot(hull[r], axis),
+                          dot(hull[t], aperp), dot(hull[i], aperp))
+        if best is None or box.area < best.area:
+            best = box
+    return best
+
+
+def obbs(polys):
+    # rotating calipers for all edges of a hull at once: edge angles increase
+    # around a convex hull, so the vertex furthest in any direction is found
+    # by binary search on them
+    boxes = []
+    for poly in polys:
+        hull = np.array(convex_hull(poly), dtype=float)
+        n = len(hull)
+        if n == 1:
+            x, y = hull[0].tolist()
+            boxes.append(OrientedBox(Point(1, 0), x, x, y, y))
+            continue
+        # edge i runs from vertex i - 1 to vertex i
+        edges = hull - np.roll(hull, 1, axis=0)
+        angles = np.arctan2(edges[:, 1], edges[:, 0])
+        turns = np.diff(angles) % (2 * np.pi)
+        # no turn of a convex hull reaches 2 pi; those are rounding errors
+        turns[turns > 1.5 * np.pi] = 0
+        angles = angles[0] + np.concatenate(([0], np.cumsum(turns)))
+        axes = edges / np.hypot(edges[:, 0], edges[:, 1])[:, None]
+        perps = np.column_stack((-axes[:, 1], axes[:, 0]))
+
+        def furthest(offset):
+            # the vertex where the hull stops advancing towards angle + offset
+            target = angles[0] + (angles + offset - angles[0]) % (2 * np.pi)
+            return (np.searchsorted(angles, target) - 1) % n
+
+        left = (hull[furthest(1.5 * np.pi)] * axes).sum(1)
+        right = (hull[furthest(0.5 * np.pi)] * axes).sum(1)
+        top = (hull[furthest(np.pi)] * perps).sum(1)
+        bottom = (hull * perps).sum(1)
+        i = ((right - left) * (top - bottom)).argmin()
+        boxes.append(OrientedBox(Point(*axes[i].tolist()), float(left[i]),
+                                 float(right[i]), float(top[i]),
+                                 float(bottom[i])))
+    return boxes
+
+
+def linedist(pt, a, b):
+    d = b - a
+    l = (d.x**2 + d.y**2)**0.5
+    if l == 0:
+        return dist(pt, a)
+    return abs(dot(pt - a, d.perp())) / l
+
+
+def collinear_indices(poly, tolerance):
+    keep = []
+    for i, pt in enumerate(poly):
+        while len(keep) >= 2 and linedist(poly[keep[-1]], poly[keep[-2]],
+                                          pt) < tolerance:
+            keep.pop()
+        keep.append(i)
+    start = 0
+    while len(keep) - start > 3:
+        if linedist(poly[keep[-1]], poly[keep[-2]],
+                    poly[keep[start]]) < tolerance:
+            keep.pop()
+        elif linedist(poly[keep[start]], poly[keep[-1]],
+                      poly[keep[start + 1]]) < tolerance:
+            start += 1
+        else:
+            break
+    return keep[start:]
+
+
+def douglas_peucker_indices(poly, tolerance):
+    n = len(poly)
+    if n < 4:
+        return list(range(n))
+    start = min(range(n), key=lambda i: poly[i])
+    order = [(start + i) % n for i in range(n)]
+    pts = np.array([poly[i] for i in order], dtype=float)
+    far = int(((pts - pts[0])**2).sum(1).argmax())
+    keep = {0, far}
+    stack = [(0, far), (far, n)]
+    while stack:
+        a, b = stack.pop()
+        if b - a < 2:
+            continue
+        pa, pb = pts[a], pts[b % n]
+        d = pb - pa
+        l = np.hypot(*d)
+        rel = pts[a + 1:b] - pa
+        if l == 0:
+            dists = np.hypot(rel[:, 0], rel[:, 1])
+        else:
+            dists = np.abs(rel[:, 0] * d[1] - rel[:, 1] * d[0]) / l
+        i = int(dists.argmax())
+        if dists[i] > tolerance:
+            keep.add(a + 1 + i)
+            stack.append((a, a + 1 + i))
+            stack.append((a + 1 + i, b))
+    return sorted(order[i] for i in keep)
+
+
+def visvalingam_indices(poly, tolerance):
+    n = len(poly)
+    prv = [i - 1 for i in range(n)]
+    nxt = [(i + 1) % n for i in range(n)]
+    prv[0] = n - 1
+
+    def effective(i):
+        return abs(signed_area(poly[prv[i]], poly[i], poly[nxt[i]]))
+
+    areas = [effective(i) for i in range(n)]
+    heap = [(a, i) for i, a in enumerate(areas)]
+    heapq.heapify(heap)
+    removed = [False] * n
+    left = n
+    while heap and left > 3:
+        a, i = heapq.heappop(heap)
+        if removed[i] or a != areas[i]:
+            continue
+        if a >= tolerance:
+            break
+        removed[i] = True
+        left -= 1
+        p, q = prv[i], nxt[i]
+        nxt[p], prv[q] = q, p
+        for j in (p, q):
+            areas[j] = max(effective(j), a)
+            heapq.heappush(heap, (areas[j], j))
+    return [i for i in range(n) if not removed[i]]
+
+
+simplifiers = {"collinear": collinear_indices,
+               "douglas-peucker": douglas_peucker_indices,
+               "visvalingam": visvalingam_indices}
+
+
+def simplifyindices(poly, tolerance=1e-2, method="collinear"):
+    poly = [Point(*p) for p in poly]
+    return np.array(simplifiers[method](poly, tolerance), dtype=int)
+
+
+def simplifypoly(poly, tolerance=1e-2, method="collinear"):
+    return [poly[i] for i in simplifyindices(poly, tolerance, method)]
+
+
+def simplifypolys(polys, tolerance=1e-2, method="collinear"):
+    return [simplifyindices(poly, tolerance, method) for poly in polys]
 
 
 def centroid(poly):
@@ -220,3 +375,119 @@ class OrientedBox(namedtuple("OrientedBox", "axis left right top bottom")):
         else:
             midp = self.left + alpha * (self.right - self.left)
             return dy * self.top + dx * midp, dy * self.bottom + dx * midp
+
+
+def bbox(pts):
+    xs = [p.x for p in pts]
+    ys = [p.y for p in pts]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+class GridIndex(object):
+    def __init__(self, cellsize):
+        self.cellsize = cellsize
+        self.cells = defaultdict(list)
+        # lowest and highest occupied cell, which bound every query
+        self.bounds = None
+
+    def cell(self, x):
+        return int(math.floor(x / self.cellsize))
+
+    def cellrange(self, x0, y0, x1, y1):
+        for i in range(self.cell(x0), self.cell(x1) + 1):
+            for j in range(self.cell(y0), self.cell(y1) + 1):
+                yield i, j
+
+    def clamped(self, x0, y0, x1, y1):
+        if self.bounds is None:
+            return
+        i0, j0, i1, j1 = self.bounds
+        for i in range(max(i0, self.cell(x0)), min(i1, self.cell(x1)) + 1):
+            for j in range(max(j0, self.cell(y0)),
+                           min(j1, self.cell(y1)) + 1):
+                yield i, j
+
+    def insert(self, box, item):
+        for cell in self.cellrange(*box):
+            self.cells[cell].append(item)
+        i0, j0, i1, j1 = (self.cell(box[0]), self.cell(box[1]),
+                          self.cell(box[2]), self.cell(box[3]))
+        if self.bounds is not None:
+            b = self.bounds
+            i0, j0, i1, j1 = (min(i0, b[0]), min(j0, b[1]),
+                              max(i1, b[2]), max(j1, b[3]))
+        self.bounds = i0, j0, i1, j1
+
+    def query(self, box):
+        found = set()
+        for cell in self.clamped(*box):
+            found.update(self.cells.get(cell, ()))
+        return found
+
+    def segmentcells(self, p, q):
+        # the cells a segment passes through, a column at a time
+        if self.bounds is None:
+            return
+        c = self.cellsize
+        if p.x > q.x:
+            p, q = q, p
+        i0 = max(self.bounds[0], self.cell(p.x))
+        i1 = min(self.bounds[2], self.cell(q.x))
+        eps = 1e-9 * c
+        for i in range(i0, i1 + 1):
+            xa, xb = max(p.x, i * c), min(q.x, (i + 1) * c)
+            if q.x > p.x:
+                ya = p.y + (xa - p.x) * (q.y - p.y) / (q.x - p.x)
+                yb = p.y + (xb - p.x) * (q.y - p.y) / (q.x - p.x)
+            else:
+                ya, yb = p.y, q.y
+            ya, yb = min(ya, yb) - eps, max(ya, yb) + eps
+            for j in range(max(self.bounds[1], self.cell(ya)),
+                           min(self.bounds[3], self.cell(yb)) + 1):
+                yield i, j
+
+    def query_segment(self, p, q):
+        found = set()
+        for cell in self.segmentcells(p, q):
+            found.update(self.cells.get(cell, ()))
+        return found
+
+
+def cellsize(boxes):
+    sizes = [max(x1 - x0, y1 - y0) for x0, y0, x1, y1 in boxes]
+    size = sum(sizes) / len(sizes) if sizes else 0
+    return size if size > 0 else 1.
+
+
+def polyedges(poly):
+    return [(poly[i - 1], poly[i]) for i in range(len(poly))]
+
+
+def overlaps_many(boxes, polys, size=None):
+    edges = [polyedges(poly) for poly in polys]
+    extents = [(i, j, bbox(e)) for i, es in enumerate(edges)
+               for j, e in enumerate(es)]
+    index = GridIndex(size or cellsize([b for _, _, b in extents]))
+    for i, j, b in extents:
+        index.insert(b, (i, j))
+    result = []
+    for box in boxes:
+        hits = set()
+        for e1 in box.edges:
+            for i, j in index.query_segment(*e1):
+                if i not in hits and intersect(e1, edges[i][j]):
+                    hits.add(i)
+        result.append(sorted(hits))
+    return result
+
+
+def in_polys(pts, polys, size=None):
+    extents = [bbox(poly) for poly in polys]
+    index = GridIndex(size or cellsize(extents))
+    for i, b in enumerate(extents):
+        index.insert(b, i)
+    result = []
+    for pt in pts:
+        result.append(sorted(i for i in index.query((pt.x, pt.y, pt.x, pt.y))
+                             if in_poly(pt, polys[i])))
+    return result
@@ -1,25 +1,116 @@
 import tracery
 import tracery.modifiers
+import hashlib
 import json
+import os
+import pickle
+import random
 import re
+import threading
 
 
-def once(text, *params, used=set()):
-    m = re.search(r"<([^>]+)>", text)
-    if m is None:
-        return text
-    tag = m.group(0)
-    if tag in used:
-        return ""
-    else:
-        used.add(tag)
-        return re.sub(r"<[^>]+>", "", text)
+def compile_rule(rule):
+    sections, errors = tracery.parse(rule)
+    if errors:
+        raise ValueError("%s: %s" % (rule, ", ".join(errors)))
+    parts = []
+    for section in sections:
+        if section['type'] == 0:
+            parts.append(section['raw'])
+        elif section['type'] == 1:
+            tag = tracery.parse_tag(section['raw'])
+            if tag['preactions']:
+                raise ValueError("%s: actions are not supported" % rule)
+            mods = []
+            for mod in tag['modifiers']:
+                m = re.match(r"([^(]*)\(([^)]+)\)", mod)
+                if m:
+                    mods.append((m.group(1), tuple(m.group(2).split(","))))
+                else:
+                    mods.append((mod, ()))
+            parts.append((tag['symbol'], tuple(mods)))
+        else:
+            raise ValueError("%s: actions are not supported" % rule)
+    return tuple(parts)
 
 
-rules = json.load(open("grammar.json"))
-grammar = tracery.Grammar(rules)
-grammar.add_modifiers(tracery.modifiers.base_english)
-grammar.add_modifiers({"once": once})
+def compile_rules(rules):
+    return dict((k, [compile_rule(r) for r in (v if isinstance(v, list)
+                                               else [v])])
+                for k, v in rules.items())
+
+
+grammarfile = "grammar.json"
+snapshotfile = "grammar.pickle"
+snapshotversion = 1
+rules = None
+rulelock = threading.Lock()
+
+
+def load_rules():
+    with rulelock:
+        return read_rules()
+
+
+def read_rules():
+    global rules
+    if rules is not None:
+        return rules
+    data = open(grammarfile, "rb").read()
+    digest = hashlib.sha1(data).hexdigest()
+    try:
+        with open(snapshotfile, "rb") as f:
+            snapshot = pickle.load(f)
+        if snapshot["version"] == snapshotversion and \
+                snapshot["digest"] == digest:
+            rules = snapshot["rules"]
+            return rules
+    except (OSError, EOFError, KeyError, TypeError, ValueError,
+            pickle.PickleError):
+        pass
+    rules = compile_rules(json.loads(data.decode("utf8")))
+    tmp = "%s.%d.tmp" % (snapshotfile, os.getpid())
+    try:
+        with open(tmp, "wb") as f:
+            pickle.dump({"version": snapshotversion, "digest": digest,
+                         "rules": rules}, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, snapshotfile)
+    except OSError:
+        # the snapshot only saves time, so carry on without it
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return rules
+
+
+modifiers = dict(tracery.modifiers.base_english)
+compiled = {}
+tagpattern = re.compile(r"<[^>]+>")
+
+
+def expand(parts, mods, rng=random):
+    text = ''
+    for part in parts:
+        if isinstance(part, str):
+            text += part
+            continue
+        symbol, partmods = part
+        if symbol in rules:
+            t = expand(rng.choice(rules[symbol]), mods, rng)
+        else:
+            t = "((%s))" % symbol
+        for name, params in partmods:
+            mod = mods.get(name)
+            if mod is None:
+                t += "((.%s))" % name
+            else:
+                t = mod(t, *params)
+        text += t
+    return text
+
+
+def clear_escape_chars(text):
+    return text.replace("\\\\", "DOUBLEBACKSLASH").replace(
+        "\\", "").replace("DOUBLEBACKSLASH", "\\")
 
 
 def const(value):
@@ -29,12 +120,70 @@ def const(value):
     return f
 
 
+def compiled_rule(rule):
+    if rule not in compiled:
+        compiled[rule] = compile_rule(rule)
+    return compiled[rule]
+
+
+class Context(object):
+    def __init__(self, rng=random):
+        self.random = rng
+        self.used = set()
+
+    def reset(self):
+        self.used = set()
+
+    def once(self, text, *params):
+        m = tagpattern.search(text)
+        if m is None:
+            return text
+        tag = m.group(0)
+        if tag in self.used:
+            return ""
+        else:
+            self.used.add(tag)
+            return tagpattern.sub("", text)
+
+    def modifiers(self, kwargs):
+        mods = dict(modifiers)
+        mods["once"] = self.once
+        for k, v in kwargs.items():
+            if isinstance(v, str):
+                v = const(v)
+            mods[k] = v
+        return mods
+
+    def flatten(self, rule, **kwargs):
+        load_rules()
+        return clear_escape_chars(expand(compiled_rule(rule),
+                                         self.modifiers(kwargs), self.random))
+
+    def lookup(self, key, **kwargs):
+        return self.flatten("#" + key + "#", **kwargs)
+
+    def expand_many(self, key, n, params={}):
+        load_rules()
+        parts = compiled_rule("#" + key + "#")
+        mods = self.modifiers(params)
+        return [clear_escape_chars(expand(parts, mods, self.random))
+                for _ in range(n)]
+
+
+context = Context()
+
+
+def once(text, *params):
+    return context.once(text, *params)
+
+
+def flatten(rule, **kwargs):
+    return context.flatten(rule, **kwargs)
+
+
 def lookup(key, **kwargs):
-    for k, v in kwargs.items():
-        if isinstance(v, str):
-            v = const(v)
-        grammar.add_modifiers({k: v})
-    return grammar.flatten("#" + key + "#")
+    return context.lookup(key, **kwargs)
 
 
-flatten = grammar.flatten
+def expand_many(key, n, params={}):
+    return context.expand_many(key, n, params)
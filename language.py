@@ -2,8 +2,10 @@
 
 # In[74]:
 
+import itertools
 import random
 import re
+import stats
 from collections import defaultdict
 
 # In[75]:
@@ -14,9 +16,19 @@ def choose(lst, exponent=2):
     return lst[int(x * len(lst))]
 
 
+def choose_weights(n, exponent=2):
+    # the probability of each index under choose(lst, exponent)
+    return [((i + 1) / n)**(1 / exponent) - (i / n)**(1 / exponent)
+            for i in range(n)]
+
+
 # In[98]:
 
 
+class LanguageExhausted(Exception):
+    pass
+
+
 class Language(object):
     def __init__(self,
                  phonemes,
@@ -37,73 +49,136 @@ class Language(object):
         self.words = defaultdict(list)
         self.allwords = set()
         self.restricts = restricts
+        self.compile_syllables()
         self.genitive = self.morpheme('of', 3)
         self.definite = self.morpheme('the', 3)
         self.joiner = random.choice('   -')
         self.minlength = 6
         self.used = []
+        self.usedset = set()
+        self.substrings = set()
         self.last_n = []
 
-    def syllable(self):
-        while True:
-            phones = []
-            for s in self.syll:
-                if s == '?':
-                    if random.random() > 0.5:
-                        phones = phones[:-1]
-                else:
-                    p = choose(self.phonemes[s], 1.5)
-                    phones.append(p)
-            syll = ''.join(phones)
-            for r in self.restricts:
-                if re.search(r, syll):
-                    break
+    def compile_syllables(self):
+        sylls = {'': 1.}
+        for s in self.syll:
+            nxt = defaultdict(float)
+            if s == '?':
+                for syll, p in sylls.items():
+                    nxt[syll] += 0.5 * p
+                    nxt[syll[:-1]] += 0.5 * p
             else:
-                return syll
+                phones = self.phonemes[s]
+                weights = choose_weights(len(phones), 1.5)
+                for syll, p in sylls.items():
+                    for ph, w in zip(phones, weights):
+                        nxt[syll + ph] += p * w
+            sylls = nxt
+        restricts = [re.compile(r) for r in self.restricts]
+        sylls = [(syll, p) for syll, p in sylls.items()
+                 if not any(r.search(syll) for r in restricts)]
+        if not sylls:
+            raise ValueError("no syllable of %s passes the restrictions" %
+                             self.syll)
+        chars = set(c for v in self.phonemes.values() for c in v)
+        table = str.maketrans(
+            dict((c, self.ortho.get(c, c.lower())) for c in chars))
+        self.syllables = [syll for syll, _ in sylls]
+        self.orthosylls = [syll.translate(table) for syll in self.syllables]
+        self.syllweights = list(itertools.accumulate(p for _, p in sylls))
+
+    def syllindex(self):
+        return random.choices(range(len(self.syllables)),
+                              cum_weights=self.syllweights)[0]
+
+    def syllable(self):
+        return self.syllables[self.syllindex()]
 
     def orthosyll(self):
-        s = self.syllable()
-        o = u""
-        for c in s:
-            o += self.ortho.get(c, c.lower())
-        return o
+        return self.orthosylls[self.syllindex()]
 
-    def morpheme(self, key=None, maxlength=None):
+    def morpheme(self, key=None, maxlength=None, fresh=False):
         morphemes = self.morphemes[key]
-        n = random.randrange(len(morphemes) + (10 if key is None else 1))
-        if n < len(morphemes):
-            return morphemes[n]
+        if not fresh:
+            n = random.randrange(len(morphemes) + (10 if key is None else 1))
+            if n < len(morphemes):
+                return morphemes[n]
         for _ in range(100):
             s = self.orthosyll()
             if maxlength and len(s) > maxlength:
                 continue
             if s not in self.allmorphemes:
                 break
+        else:
+            unused = self.unused_syllables(maxlength)
+            if unused:
+                s = self.orthosylls[random.choices(
+                    unused, [self.syllweight(i) for i in unused])[0]]
         morphemes.append(s)
         self.allmorphemes.add(s)
         return s
 
-    def word(self, key=None):
+    def syllweight(self, i):
+        return self.syllweights[i] - (self.syllweights[i - 1] if i else 0)
+
+    def unused_syllables(self, maxlength=None):
+        return [i for i, s in enumerate(self.orthosylls)
+                if s not in self.allmorphemes and
+                not (maxlength and len(s) > maxlength)]
+
+    def capacity(self):
+        # an upper bound on the number of words not yet generated
+        n = len(set(self.orthosylls) | self.allmorphemes)
+        total = sum(n**l for l in range(*self.wordlength))
+        return max(total - len(self.allwords), 0)
+
+    def newword(self, key=None, attempts=1, fresh=False):
+        for _ in range(attempts):
+            l = random.randrange(*self.wordlength)
+            keys = [key] + [None for _ in range(l - 1)]
+            random.shuffle(keys)
+            w = ''.join(self.morpheme(k, fresh=fresh and k == key)
+                        for k in keys)
+            if w not in self.allwords:
+                self.words[key].append(w)
+                self.allwords.add(w)
+                return w
+        return None
+
+    def word(self, key=None, attempts=1000):
         ws = self.words[key]
-        while True:
+        for _ in range(attempts):
             n = random.randrange(len(ws) + 3 + len(ws) // 8)
             if n < len(ws):
                 if ws[n] in self.last_n:
+                    stats.count("language.word.retries")
                     continue
                 self.last_n.append(ws[n])
                 self.last_n = self.last_n[-3:]
                 return ws[n]
-            l = random.randrange(*self.wordlength)
-            keys = [key] + [None for _ in range(l - 1)]
-            random.shuffle(keys)
-            w = ''.join(self.morpheme(k) for k in keys)
-            if w in self.allwords:
+            w = self.newword(key)
+            if w is None:
+                stats.count("language.word.retries")
                 continue
-            ws.append(w)
-            self.allwords.add(w)
             self.last_n.append(w)
             self.last_n = self.last_n[-3:]
             return w
+        raise LanguageExhausted("no usable %r word after %d attempts" %
+                                (key, attempts))
+
+    def generate_lexicon(self, key=None, n=1, attempts=100):
+        if n > self.capacity():
+            raise LanguageExhausted("%d new %r words requested, at most %d "
+                                    "remain" % (n, key, self.capacity()))
+        words = []
+        for _ in range(n):
+            w = (self.newword(key, attempts) or
+                 self.newword(key, attempts, fresh=True))
+            if w is None:
+                raise LanguageExhausted("only %d of %d new %r words found" %
+                                        (len(words), n, key))
+            words.append(w)
+        return words
 
     def name(self,
              key=None,
@@ -118,6 +193,7 @@ class Language(object):
                 w2 = self.word(key
                                if random.random() < 0.6 else None).capitalize()
                 if w1 == w2:
+                    stats.count("language.name.retries")
                     continue
                 if random.random() > 0.5:
                     p = self.joiner.join([w1, self.genitive, w2])
@@ -127,15 +203,32 @@ class Language(object):
                 p = self.word(key).capitalize()
             if random.random() < definite:
                 p = self.joiner.join([self.definite, p])
-            if not hasattr(self, "used"):
-                self.used = []
-            for p2 in self.used:
-                if p in p2 or p2 in p:
-                    break
-            else:
-                if minlength <= len(p) <= maxlength:
-                    self.used.append(p)
-                    return p
+            if minlength <= len(p) <= maxlength and not self.collides(p):
+                self.use(p)
+                return p
+            stats.count("language.name.retries")
+
+    def names(self, key=None, count=1, **kwargs):
+        return [self.name(key, **kwargs) for _ in range(count)]
+
+    def collides(self, p):
+        if not hasattr(self, "substrings"):
+            used = getattr(self, "used", [])
+            self.used, self.usedset, self.substrings = [], set(), set()
+            for p2 in used:
+                self.use(p2)
+        if p in self.substrings:
+            return True
+        n = len(p)
+        return any(p[i:j] in self.usedset
+                   for i in range(n) for j in range(i + 1, n + 1))
+
+    def use(self, p):
+        self.used.append(p)
+        self.usedset.add(p)
+        n = len(p)
+        self.substrings.update(p[i:j]
+                               for i in range(n) for j in range(i + 1, n + 1))
 
 
 # In[101]:
@@ -6,26 +6,48 @@ structures = [
         (("noun", "adjective"), (0, 1))
         ]
 
+# plans[r] is the chance that uniformly chosen structures add up to exactly
+# r words
+plans = [1.]
+
+
+def planweights(nwords):
+    while len(plans) <= nwords:
+        r = len(plans)
+        plans.append(sum(plans[r - len(forms)] for forms, _ in structures
+                         if len(forms) <= r) / len(structures))
+    return plans
+
+
+def plan(nwords):
+    # structures drawn uniformly, conditioned on totalling nwords words
+    weights = planweights(nwords)
+    if not weights[nwords]:
+        raise ValueError("no sequence of structures has %d words" % nwords)
+    chosen = []
+    while nwords:
+        options = [s for s in structures if len(s[0]) <= nwords]
+        struct = random.choices(
+            options, [weights[nwords - len(s[0])] for s in options])[0]
+        chosen.append(struct)
+        nwords -= len(struct[0])
+    return chosen
+
 
 class Poem(object):
     def __init__(self, lines=3):
-        while True:
-            self.sentences = []
-            self.structures = []
-            self.words = []
-            while len(self.words) < lines * 3:
-                struct = random.choice(structures)
-                forms, _ = struct
-                sent = [translation.langword(form) for form in forms]
-                self.sentences.append(sent)
-                self.structures.append(struct)
-                self.words.extend(sent)
-            if len(self.words) % 3 == 0:
-                break
+        self.structures = plan(lines * 3)
+        self.sentences = [[translation.langword(form) for form in forms]
+                          for forms, _ in self.structures]
+        self.words = [w for sent in self.sentences for w in sent]
         self.lines = []
         for i in range(len(self.words) // 3):
             self.lines.append(self.words[3 * i:3 * i + 3])
 
+    @classmethod
+    def batch(cls, n, lines=3):
+        return [cls(lines) for _ in range(n)]
+
     def gloss(self):
         gloss = []
         for struct, sent in zip(self.structures, self.sentences):
@@ -1,7 +1,10 @@
 import svg
 from geom import Point
+from functools import lru_cache
 import math
+import numpy as np
 import random
+import stats
 
 
 class Glyph(object):
@@ -11,6 +14,7 @@ class Glyph(object):
         if offset is None:
             offset = (self.points[-1].x, 0)
         self.offset = Point(*offset)
+        self.array = np.array(self.points, dtype=float)
 
     def flipped(self):
         points = [(p.x, -p.y) for p in self.points]
@@ -57,87 +61,132 @@ allglyphs = [loopup, loopdown, hookup, hookdown, curldown,
 #offset=(0.5, 0))
 
 
-def join(glyphs):
+def asarrays(runs):
+    return [np.asarray(run, dtype=float).reshape(-1, 2) for run in runs]
+
+
+def aspoints(runs):
+    return [[Point(*p) for p in np.asarray(run).tolist()] for run in runs]
+
+
+def joinarrays(glyphs):
     runs = []
-    offset = Point(0, 0)
-    points = []
+    offset = np.zeros(2)
+    pieces = []
     for g in glyphs:
-        pts = g.points
-        if points:
-            points = points[:-1]
+        pts = g.array
+        if pieces:
+            pieces[-1] = pieces[-1][:-1]
             pts = pts[1:]
-        points += [offset + p for p in pts]
-        offset += g.offset
+        pieces.append(offset + pts)
+        offset = offset + g.offset
         if g.broken:
-            runs.append(points)
-            points = []
-    if points:
-        runs.append(points)
+            runs.append(np.concatenate(pieces))
+            pieces = []
+    if pieces:
+        runs.append(np.concatenate(pieces))
     return runs
 
 
+def join(glyphs):
+    return aspoints(joinarrays(glyphs))
+
+
 def bestp(p2, p3, p4, tau):
     return p4 + p3 - p2 - 6 * tau * (p3 - p2)
 
 
+def pathdata(runs, tau=0.5):
+    d = []
+    for run in asarrays(runs):
+        run = np.concatenate((
+            [bestp(run[0], run[1], run[2], tau)], run,
+            [bestp(run[-1], run[-2], run[-3], tau)]))
+        d.append('M %.2f,%.2f' % tuple(run[1]))
+        p1, p2, p3, p4 = run[:-3], run[1:-2], run[2:-1], run[3:]
+        segs = np.hstack((p2 + (p3 - p1) / (6 * tau),
+                          p3 - (p4 - p2) / (6 * tau), p3))
+        d.extend(' C %.2f,%.2f %.2f,%.2f %.2f,%.2f' % tuple(seg)
+                 for seg in segs.tolist())
+    return ''.join(d)
+
+
 def path(runs, tau=0.5):
-    d = ''
-    for run in runs:
-        run = [bestp(run[0], run[1], run[2], tau)] + run + [
-            bestp(run[-1], run[-2], run[-3], tau)
-        ]
-        d += 'M %.2f,%.2f' % run[1]
-        for i in range(len(run) - 3):
-            p1 = run[i]
-            p2 = run[i + 1]
-            p3 = run[i + 2]
-            p4 = run[i + 3]
-            pts = [p2 + (p3 - p1) / (6 * tau), p3 - (p4 - p2) / (6 * tau), p3]
-            d += ' C'
-            for pt in pts:
-                d += ' %.2f,%.2f' % pt
-    return svg.Path(d=d)
+    return svg.Path(d=pathdata(runs, tau))
 
 
 def mappts(runs, f):
     return [[f(p) for p in run] for run in runs]
 
 
+def lineararrays(runs, scale=100.):
+    return [scale * run for run in runs]
+
+
 def linear(runs, scale=100.):
-    return mappts(runs, lambda p: scale * p)
+    return aspoints(lineararrays(asarrays(runs), scale))
+
+
+def circulararrays(runs, rscale=20., thetascale=1.):
+    out = []
+    for run in runs:
+        r = rscale * np.sqrt(1.25 + run[:, 1])
+        theta = thetascale * run[:, 0]
+        out.append(np.column_stack((r * np.cos(theta), r * np.sin(theta))))
+    return out
 
 
 def circular(runs, rscale=20., thetascale=1.):
-    def f(p):
-        return rscale * (1.25 + p.y) ** 0.5 * \
-                Point(math.cos(thetascale * p.x),
-                      math.sin(thetascale * p.x))
+    return aspoints(circulararrays(asarrays(runs), rscale, thetascale))
 
-    return mappts(runs, f)
 
+def noisyarrays(runs, r=0.):
+    rng = np.random.RandomState(random.getrandbits(32))
+    return [run + rng.normal(0, r, run.shape) for run in runs]
 
-def noisy(cmds, r=0.):
-    def f(p):
-        return p + Point(random.gauss(0, r), random.gauss(0, r))
 
-    return mappts(cmds, f)
+def noisy(cmds, r=0.):
+    return aspoints(noisyarrays(asarrays(cmds), r))
 
 
-def ring(glyphs):
+def thetascale(glyphs):
     offset = Point(0, 0)
     for g in glyphs:
         offset += g.offset
-    thetascale = 2 * math.pi / (offset.x + 0.5)
-    return path(noisy(circular(join(glyphs), thetascale=thetascale)))
+    return 2 * math.pi / (offset.x + 0.5)
+
+
+def ring(glyphs, noise=0.):
+    runs = circulararrays(joinarrays(glyphs), thetascale=thetascale(glyphs))
+    if noise:
+        runs = noisyarrays(runs, noise)
+    return path(runs)
 
 
 glyphdict = dict(zip('AEIOUPTKMSL'.lower(), allglyphs))
 
 
-def makeglyph(word, x, y, theta, label=True):
+@lru_cache(maxsize=4096)
+def wordring(word):
     glyphs = [glyphdict[c] for c in word]
+    runs = circulararrays(joinarrays(glyphs), thetascale=thetascale(glyphs))
+    for run in runs:
+        run.flags.writeable = False
+    return tuple(runs)
+
+
+@lru_cache(maxsize=4096)
+def wordpath(word):
+    return pathdata(wordring(word))
+
+
+def makeglyph(word, x, y, theta, label=True, noise=0.):
+    if noise:
+        d = pathdata(noisyarrays(wordring(word), noise))
+    else:
+        d = wordpath(word)
     g = svg.Group(
-        ring(glyphs),
+        svg.Path(d=d),
         transform='translate(%.2f, %.2f) rotate(%.2f)' % (x, y, theta))
     if label:
         g.append(
@@ -173,6 +222,11 @@ def renderglyph(word, scale=60):
 
 
 def renderpoem(poem, scale=60):
+    with stats.timer("script.renderpoem"):
+        return drawpoem(poem, scale)
+
+
+def drawpoem(poem, scale=60):
     r = radius(len(poem)) + 0.3
     s = svg.SVG(
         width=2 * r * scale,
@@ -196,6 +250,7 @@ def renderpoem(poem, scale=60):
             x = scale * r * math.cos(math.radians(theta))
             y = scale * r * math.sin(math.radians(theta))
             g.append(makeglyph(word, x, y, theta, label=False))
+            stats.count("script.glyphs")
     return s
 
 if __name__ == '__main__':
@@ -0,0 +1,168 @@
+import csv
+import json
+import threading
+import time
+from collections import defaultdict
+
+enabled = False
+times = defaultdict(float)
+calls = defaultdict(int)
+counts = defaultdict(int)
+rows = []
+# the row being charged is per thread, so pipeline stages can each work on
+# a different poem
+local = threading.local()
+# guards the totals and rows, which several threads may update at once
+lock = threading.Lock()
+
+
+class Timer(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        row = currentrow()
+        with lock:
+            times[self.name] += elapsed
+            calls[self.name] += 1
+            if row is not None:
+                row["times"][self.name] += elapsed
+        return False
+
+
+class NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+nulltimer = NullTimer()
+
+
+def enable(on=True):
+    global enabled
+    enabled = on
+
+
+def timer(name):
+    if not enabled:
+        return nulltimer
+    return Timer(name)
+
+
+def count(name, n=1):
+    if not enabled:
+        return
+    row = currentrow()
+    with lock:
+        counts[name] += n
+        if row is not None:
+            row["counts"][name] += n
+
+
+def currentrow():
+    return getattr(local, "row", None)
+
+
+def setrow(row):
+    local.row = row
+
+
+def begin(**fields):
+    # later timers and counters in this thread are also charged to this row
+    if not enabled:
+        return None
+    row = dict(fields, times=defaultdict(float), counts=defaultdict(int))
+    with lock:
+        rows.append(row)
+    setrow(row)
+    return row
+
+
+def end():
+    setrow(None)
+
+
+def reset():
+    times.clear()
+    calls.clear()
+    counts.clear()
+    del rows[:]
+    setrow(None)
+
+
+def snapshot():
+    return {"times": dict(times), "calls": dict(calls),
+            "counts": dict(counts)}
+
+
+def merge(snap, into=None):
+    # add a snapshot taken elsewhere (e.g. in a worker) to the totals and,
+    # if given, to a row
+    with lock:
+        for k, v in snap["times"].items():
+            times[k] += v
+            if into is not None:
+                into["times"][k] += v
+        for k, v in snap["calls"].items():
+            calls[k] += v
+        for k, v in snap["counts"].items():
+            counts[k] += v
+            if into is not None:
+                into["counts"][k] += v
+
+
+def isolated(f, *args):
+    # run f with fresh totals and return its result and what it recorded
+    reset()
+    result = f(*args)
+    snap = snapshot()
+    reset()
+    return result, snap
+
+
+def columns():
+    names = set()
+    for r in rows:
+        names.update("time:" + k for k in r["times"])
+        names.update("count:" + k for k in r["counts"])
+    fields = [k for k in rows[0] if k not in ("times", "counts")] \
+        if rows else []
+    return fields + sorted(names)
+
+
+def flatrow(r):
+    flat = dict((k, v) for k, v in r.items() if k not in ("times", "counts"))
+    flat.update(("time:" + k, v) for k, v in r["times"].items())
+    flat.update(("count:" + k, v) for k, v in r["counts"].items())
+    return flat
+
+
+def report(filename):
+    if filename.endswith(".csv"):
+        with open(filename, "w", newline="") as f:
+            writer = csv.DictWriter(f, columns(), restval=0)
+            writer.writeheader()
+            for r in rows:
+                writer.writerow(flatrow(r))
+    else:
+        with open(filename, "w") as f:
+            json.dump({"totals": dict((k, {"seconds": times[k],
+                                           "calls": calls[k]})
+                                      for k in times),
+                       "counts": counts,
+                       "rows": rows}, f, indent=1, sort_keys=True)
+
+
+def summary():
+    lines = ["%-24s %8d calls %10.3fs" % (k, calls[k], times[k])
+             for k in sorted(times, key=times.get, reverse=True)]
+    lines.extend("%-24s %8d" % (k, counts[k]) for k in sorted(counts))
+    return "\n".join(lines)
@@ -1,5 +1,8 @@
+import cairocffi as cairo
 import cairosvg
+import math
 import re
+import stats
 from geom import Point, normalize, dist
 
 
@@ -13,30 +16,60 @@ class Element(object):
         for k, v in kwargs.items():
             setattr(self, k, v)
 
-    def __str__(self):
-        s = '<%s' % self._element
-        attrs = [a for a in vars(self) if not a.startswith('_')]
-        for a in attrs:
-            s += ' %s="%s"' % (re.sub('_', '-', a), str(getattr(self, a)))
+    def iter_chunks(self):
+        yield '<%s' % self._element
+        for a in vars(self):
+            if not a.startswith('_'):
+                yield ' %s="%s"' % (a.replace('_', '-'), getattr(self, a))
         if self._contents:
-            s += '>\n'
+            yield '>\n'
             for c in self._contents:
-                s += str(c)
-            s += '</%s>\n' % self._element
+                if hasattr(c, 'iter_chunks'):
+                    yield from c.iter_chunks()
+                else:
+                    yield str(c)
+            yield '</%s>\n' % self._element
         else:
-            s += '/>\n'
-        return s
+            yield '/>\n'
+
+    def write(self, fp):
+        fp.writelines(self.iter_chunks())
+
+    def __str__(self):
+        return ''.join(self.iter_chunks())
 
     def append(self, x):
         self._contents.append(x)
 
     def save(self, filename):
         with open(filename, "w") as f:
-            f.write(str(self))
+            self.write(f)
 
-    def savepdf(self, filename):
-        cairosvg.svg2pdf(
-            bytestring=str(self).encode("utf8"), write_to=filename)
+    def savepdf(self, filename, direct=False):
+        if direct:
+            with stats.timer("pdf.draw"):
+                savepdfs([self], filename)
+        else:
+            with stats.timer("svg.serialize"):
+                data = str(self).encode("utf8")
+            with stats.timer("pdf.convert"):
+                cairosvg.svg2pdf(bytestring=data, write_to=filename)
+
+    def draw(self, ctx, style={}):
+        attrs = dict((k, v) for k, v in vars(self).items()
+                     if not k.startswith('_'))
+        ctx.save()
+        transform(ctx, attrs.pop('transform', ''))
+        style = dict(style, **attrs)
+        if self.shape(ctx, style):
+            paint(ctx, style)
+        for c in self._contents:
+            if hasattr(c, 'draw'):
+                c.draw(ctx, style)
+        ctx.restore()
+
+    def shape(self, ctx, style):
+        return False
 
 
 class SVG(Element):
@@ -55,27 +88,75 @@ class Group(Element):
 class Circle(Element):
     _element = 'circle'
 
+    def shape(self, ctx, style):
+        r = float(self.r)
+        ctx.new_sub_path()
+        ctx.arc(float(self.cx), float(self.cy), r, 0, 2 * math.pi)
+        return True
+
 
 class Rect(Element):
     _element = 'rect'
 
+    def shape(self, ctx, style):
+        x = float(getattr(self, 'x', 0))
+        y = float(getattr(self, 'y', 0))
+        ctx.rectangle(x, y, float(self.width), float(self.height))
+        return True
+
 
 class Line(Element):
     _element = 'line'
 
+    def shape(self, ctx, style):
+        ctx.move_to(float(self.x1), float(self.y1))
+        ctx.line_to(float(self.x2), float(self.y2))
+        return True
+
 
 class Path(Element):
     _element = 'path'
 
+    def shape(self, ctx, style):
+        pathcommands(ctx, self.d)
+        return True
+
 
 class Text(Element):
     _element = 'text'
 
+    def draw(self, ctx, style={}):
+        attrs = dict((k, v) for k, v in vars(self).items()
+                     if not k.startswith('_'))
+        ctx.save()
+        transform(ctx, attrs.pop('transform', ''))
+        style = dict(style, **attrs)
+        text = ''.join(str(c) for c in self._contents)
+        ctx.select_font_face(style.get('font_family', 'sans-serif'))
+        ctx.set_font_size(float(style.get('font_size', 16)))
+        xb, yb, w, h, _, _ = ctx.text_extents(text)
+        x = float(style.get('x', 0))
+        y = float(style.get('y', 0))
+        anchor = style.get('text_anchor', 'start')
+        if anchor == 'middle':
+            x -= xb + w / 2
+        elif anchor == 'end':
+            x -= xb + w
+        if style.get('alignment_baseline') == 'middle':
+            y -= yb + h / 2
+        ctx.move_to(x, y)
+        ctx.text_path(text)
+        paint(ctx, style)
+        ctx.restore()
+
 
 class Comment(object):
     def __init__(self, text):
         self.text = text
 
+    def iter_chunks(self):
+        yield "<!-- %s -->\n" % self.text
+
     def __str__(self):
         return "<!-- %s -->\n" % self.text
 
@@ -100,3 +181,119 @@ def polypath(*polys, **kwargs):
             started = True
         d += 'z'
     return Path(d=d, **kwargs)
+
+
+colors = {
+    "black": (0, 0, 0),
+    "white": (1, 1, 1),
+    "lightgrey": (211 / 255., 211 / 255., 211 / 255.),
+    "grey": (128 / 255., 128 / 255., 128 / 255.),
+    "red": (1, 0, 0),
+    "green": (0, 128 / 255., 0),
+    "blue": (0, 0, 1),
+}
+
+
+def color(name):
+    name = str(name)
+    if name.startswith('#'):
+        h = name[1:]
+        if len(h) == 3:
+            h = ''.join(c * 2 for c in h)
+        return tuple(int(h[i:i + 2], 16) / 255. for i in (0, 2, 4))
+    return colors.get(name, (0, 0, 0))
+
+
+def transform(ctx, t):
+    for op, args in re.findall(r"(\w+)\s*\(([^)]*)\)", str(t)):
+        args = [float(a) for a in re.split(r"[\s,]+", args.strip()) if a]
+        if op == 'translate':
+            ctx.translate(args[0], args[1] if len(args) > 1 else 0)
+        elif op == 'rotate':
+            if len(args) == 3:
+                ctx.translate(args[1], args[2])
+            ctx.rotate(math.radians(args[0]))
+            if len(args) == 3:
+                ctx.translate(-args[1], -args[2])
+        elif op == 'scale':
+            ctx.scale(args[0], args[1] if len(args) > 1 else args[0])
+        elif op == 'matrix':
+            ctx.transform(cairo.Matrix(*args))
+
+
+def pathcommands(ctx, d):
+    tokens = re.findall(r"[A-Za-z]|[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?",
+                        d)
+    cmd = None
+    start = cur = Point(0, 0)
+    i = 0
+    while i < len(tokens):
+        if tokens[i].isalpha():
+            cmd = tokens[i]
+            i += 1
+            if cmd in 'Zz':
+                ctx.close_path()
+                cur = start
+                continue
+        nargs = {'M': 2, 'L': 2, 'C': 6, 'Q': 4}[cmd.upper()]
+        args = [float(a) for a in tokens[i:i + nargs]]
+        i += nargs
+        pts = [Point(args[j], args[j + 1]) for j in range(0, nargs, 2)]
+        if cmd.islower():
+            pts = [cur + p for p in pts]
+        if cmd in 'Mm':
+            ctx.move_to(*pts[0])
+            start = pts[0]
+            cmd = 'l' if cmd == 'm' else 'L'
+        elif cmd in 'Ll':
+            ctx.line_to(*pts[0])
+        elif cmd in 'Cc':
+            ctx.curve_to(*sum(map(tuple, pts), ()))
+        elif cmd in 'Qq':
+            c1 = cur + (pts[0] - cur) * (2 / 3.)
+            c2 = pts[1] + (pts[0] - pts[1]) * (2 / 3.)
+            ctx.curve_to(*sum(map(tuple, (c1, c2, pts[1])), ()))
+        cur = pts[-1]
+
+
+linecaps = {'round': cairo.LINE_CAP_ROUND, 'square': cairo.LINE_CAP_SQUARE}
+linejoins = {'round': cairo.LINE_JOIN_ROUND, 'bevel': cairo.LINE_JOIN_BEVEL}
+
+
+def paint(ctx, style):
+    fill = style.get('fill', 'black')
+    stroke = style.get('stroke', 'none')
+    if fill != 'none':
+        ctx.set_source_rgb(*color(fill))
+        ctx.fill_preserve()
+    if stroke != 'none':
+        ctx.set_source_rgb(*color(stroke))
+        ctx.set_line_width(float(style.get('stroke_width', 1)))
+        ctx.set_line_cap(linecaps.get(style.get('stroke_linecap'),
+                                      cairo.LINE_CAP_BUTT))
+        ctx.set_line_join(linejoins.get(style.get('stroke_linejoin'),
+                                        cairo.LINE_JOIN_MITER))
+        ctx.stroke_preserve()
+    ctx.new_path()
+
+
+# cairosvg maps SVG pixels at 96dpi onto 72dpi PDF points
+PX = 0.75
+
+
+def savepdfs(elements, filename):
+    surface = None
+    for e in elements:
+        width, height = float(e.width) * PX, float(e.height) * PX
+        if surface is None:
+            surface = cairo.PDFSurface(filename, width, height)
+            ctx = cairo.Context(surface)
+        else:
+            surface.set_size(width, height)
+        ctx.save()
+        ctx.scale(PX, PX)
+        e.draw(ctx)
+        ctx.restore()
+        ctx.show_page()
+    if surface is not None:
+        surface.finish()
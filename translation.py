@@ -1,7 +1,11 @@
-import spacy
+from functools import lru_cache
+import json
+import os
 import numpy as np
-import inflect
+import ann
 import language
+import stats
+import vectors
 
 np.random.seed(0)
 
@@ -10,44 +14,34 @@ lang = language.Language(
               'C': 'PTKMSL'}, syll='CV', wordlength=(3, 6))
 
 
-nlp = spacy.load('en', tagger=False, parser=False, entity=False, matcher=False)
+wordlists = vectors.load_wordlists()
+words = dict(wordlists)
+matrices = vectors.load(wordlists)
+nouns = words["noun"]
+verbs = words["verb"]
+adjectives = words["adjective"]
 
 
-def load_words(filename):
-    return [nlp(w) for w in open(filename).read().split("\n") if w.strip()]
-
-
-nouns = load_words("nouns.txt")
-verbs = load_words("verbs.txt")
-adjectives = load_words("adjectives.txt")
-
-for word in nouns + verbs + adjectives:
-    assert word.vector.sum() != 0.0, word
 def cosine(u, v):
     return np.dot(u, v) / (np.dot(u, u) * np.dot(v, v))**0.5
 
 
-def randomsense():
-    return np.random.randn(300)
-
-
-def bestvector(w):
-    return max(w, key=len).vector
-
-
-def getword(sense, form, cutoff=0.13):
-    words = {"noun": nouns, "verb": verbs, "adjective": adjectives}[form]
-    p = np.array([cosine(bestvector(w), sense) for w in words])
+def readings(p, words, cutoff, ids=None):
+    # ids maps entries of p to words, when p only covers some of them
     if p.max() < cutoff:
         return []
     p[p < cutoff] = -1000
     p -= p.max()
     p = np.exp(20 * p)
     p /= p.sum()
-    words = [w.text for w in words]
 
+    # at most two meanings are used, so only those tied with the top two
+    # need sorting
+    k = min(2, len(p))
+    top = np.flatnonzero(p >= max(-np.partition(-p, k - 1)[k - 1], 1e-3))
+    wordids = top if ids is None else ids[top]
     allmeanings = [(p_, w) for p_, w in sorted(
-        zip(p, words), reverse=True) if p_ > 1e-3]
+        zip(p[top], [words[i] for i in wordids]), reverse=True) if p_ > 1e-3]
 
     meanings = []
     totalp = 0
@@ -59,23 +53,210 @@ def getword(sense, form, cutoff=0.13):
     return meanings
 
 
-lexicon = {}
+# word lists longer than this are searched approximately; nprobe is the
+# number of clusters scored per lookup, trading recall for speed (probing
+# all of them gives the exact readings)
+exactsize = 20000
+nprobe = 128
+indexes = {}
+
+
+def index(form):
+    if len(words[form]) <= exactsize:
+        return None
+    if form not in indexes:
+        indexes[form] = ann.IVFIndex(matrices[form])
+    return indexes[form]
+
+
+def getword(sense, form, cutoff=0.13):
+    with stats.timer("translation.getword"):
+        idx = index(form)
+        if idx is not None:
+            ids, p = idx.search(sense, nprobe)
+            return readings(p, words[form], cutoff, ids)
+        p = matrices[form].dot(sense) / np.dot(sense, sense)**0.5
+        return readings(p, words[form], cutoff)
+
+
+def getword_many(senses, form, cutoff=0.13):
+    if index(form) is not None:
+        return [getword(sense, form, cutoff) for sense in senses]
+    senses = np.asarray(senses)
+    p = senses.dot(matrices[form].T)
+    p /= np.sqrt((senses * senses).sum(1))[:, None]
+    return [readings(row, words[form], cutoff) for row in p]
+
+
+formnames = [form for form, _ in vectors.wordfiles]
+
+
+class Lexicon(object):
+    # word -> (sense, form), with every sense a float32 row of one growable
+    # matrix, and each word's readings remembered once computed
+    blocksize = 256
+
+    def __init__(self, items=()):
+        self.index = {}
+        self.wordlist = []
+        self.senses = np.zeros((0, 300), dtype=np.float32)
+        self.codes = np.zeros(0, dtype=np.uint8)
+        self.pending = np.zeros((0, 300))
+        self.readings = {}
+        self.known = {}
+        for word, entry in items:
+            self[word] = entry
+
+    def __len__(self):
+        return len(self.wordlist)
+
+    def __contains__(self, word):
+        return word in self.index
+
+    def __iter__(self):
+        return iter(self.wordlist)
+
+    def __getitem__(self, word):
+        row = self.index[word]
+        return self.senses[row], formnames[self.codes[row]]
+
+    def __setitem__(self, word, entry):
+        sense, form = entry
+        row = self.index.get(word)
+        if row is None:
+            row = len(self.wordlist)
+            if row == len(self.senses):
+                self.grow(max(2 * row, self.blocksize))
+            self.index[word] = row
+            self.wordlist.append(word)
+        self.senses[row] = sense
+        self.codes[row] = formnames.index(form)
+        self.readings.pop(word, None)
+
+    def get(self, word, default=None):
+        return self[word] if word in self.index else default
+
+    def items(self):
+        return ((w, self[w]) for w in self.wordlist)
+
+    def grow(self, rows):
+        senses = np.zeros((rows, 300), dtype=np.float32)
+        senses[:len(self.senses)] = self.senses
+        codes = np.zeros(rows, dtype=np.uint8)
+        codes[:len(self.codes)] = self.codes
+        self.senses, self.codes = senses, codes
+
+    def newsense(self):
+        # senses are drawn from np.random in blocks, which yields the same
+        # values as drawing them one at a time
+        if not len(self.pending):
+            self.pending = np.random.randn(self.blocksize, 300)
+        sense, self.pending = self.pending[0], self.pending[1:]
+        return sense
+
+    def add(self, word, form):
+        self[word] = self.newsense(), form
+
+    def matrix(self):
+        # a view of every sense, one row per word in wordlist order
+        return self.senses[:len(self.wordlist)]
+
+    def rows(self, words):
+        return np.array([self.index[w] for w in words], dtype=int)
+
+    def translate(self, word):
+        if word not in self.readings:
+            sense, form = self[word]
+            known = self.known.get(word)
+            if known is not None and known[1] == form and \
+                    np.array_equal(known[0], sense):
+                self.readings[word] = known[2]
+            else:
+                self.readings[word] = getword(sense, form)
+        return self.readings[word]
+
+    def translate_many(self, words):
+        # compute missing readings with one matrix product per form
+        todo = [w for w in words if w not in self.readings]
+        for code, form in enumerate(formnames):
+            ws = [w for w in todo if self.codes[self.index[w]] == code]
+            if ws:
+                senses = self.senses[self.rows(ws)]
+                for w, r in zip(ws, getword_many(senses, form)):
+                    self.readings[w] = r
+        return [self.readings[w] for w in words]
+
+    def reuse(self, other):
+        # take readings from another lexicon for words that get the same
+        # sense here, without otherwise changing what is generated
+        for word, (sense, form) in other.items():
+            if word in other.readings:
+                self.known[word] = sense, form, other.readings[word]
+
+    def save(self, filename):
+        order = np.argsort(self.wordlist, kind='stable')
+        tmp = "%s.%d.tmp" % (filename, os.getpid())
+        with open(tmp, "wb") as f:
+            np.savez(f,
+                     words=np.array(self.wordlist, dtype=str)[order],
+                     forms=np.array(formnames, dtype=str)[
+                         self.codes[:len(self)][order]],
+                     senses=self.matrix()[order],
+                     readings=np.array(json.dumps(self.readings)),
+                     key=np.array(readingskey()))
+        os.replace(tmp, filename)
+
+
+def readingskey():
+    # readings are only valid for the word lists they were computed from
+    return vectors.cachefile(wordlists)
+
+
+def loadlexicon(filename):
+    data = np.load(filename)
+    lex = Lexicon(zip(data["words"].tolist(),
+                      zip(data["senses"], data["forms"].tolist())))
+    if str(data["key"]) == readingskey():
+        lex.readings = json.loads(str(data["readings"]))
+    return lex
+
+
+lexicon = Lexicon()
+
+
+def getstate():
+    return lang, lexicon, np.random.get_state()
+
+
+def setstate(state):
+    global lang, lexicon
+    lang, lexicon, randomstate = state
+    if not isinstance(lexicon, Lexicon):
+        lexicon = Lexicon(lexicon.items())
+    np.random.set_state(randomstate)
+
 
 def langword(form):
     word = lang.word(form)
     if word not in lexicon:
-        lexicon[word] = randomsense(), form
+        lexicon.add(word, form)
     return word
 
-inflect = inflect.engine()
+inflector = None
 
 
+@lru_cache(maxsize=None)
 def infinitive(verb):
+    global inflector
     if verb.startswith("is "):
         return "be " + verb[3:]
     else:
+        if inflector is None:
+            import inflect
+            inflector = inflect.engine()
         words = verb.split()
-        words[0] = inflect.plural_verb(words[0])
+        with stats.timer("translation.infinitive"):
+            words[0] = inflector.plural_verb(words[0])
         return ' '.join(words)
 
 
@@ -88,7 +269,7 @@ def strip_a(noun):
 
 
 def translate(word):
-    ws = getword(*lexicon[word])
+    ws = list(lexicon.translate(word))
     _, form = lexicon[word]
     if form == 'adjective':
         ws = ["is " + w for w in ws]
@@ -0,0 +1,77 @@
+import glob
+import hashlib
+import os
+import numpy as np
+
+wordfiles = [("noun", "nouns.txt"),
+             ("verb", "verbs.txt"),
+             ("adjective", "adjectives.txt")]
+
+
+def read_words(filename):
+    return [w for w in open(filename).read().split("\n") if w.strip()]
+
+
+def load_wordlists():
+    return [(form, read_words(filename)) for form, filename in wordfiles]
+
+
+def cachefile(wordlists):
+    h = hashlib.sha1()
+    for form, words in wordlists:
+        h.update(("%s:%s\n" % (form, "\n".join(words))).encode("utf8"))
+    return "vectors-%s.npy" % h.hexdigest()[:16]
+
+
+def bestvector(w):
+    return max(w, key=len).vector
+
+
+def save(wordlists, m):
+    m = np.asarray(m, dtype=float)
+    m = m / np.sqrt((m * m).sum(1))[:, None]
+    filename = cachefile(wordlists)
+    tmp = "%s.%d.tmp" % (filename, os.getpid())
+    try:
+        with open(tmp, "wb") as f:
+            np.save(f, m)
+        os.replace(tmp, filename)
+        for old in glob.glob("vectors-*.npy"):
+            if old != filename:
+                os.remove(old)
+    except OSError:
+        # without a cache the vectors are just rebuilt next time
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return m
+
+
+def build(wordlists):
+    import spacy
+    nlp = spacy.load('en', tagger=False, parser=False, entity=False,
+                     matcher=False)
+    docs = [nlp(w) for _, words in wordlists for w in words]
+    for doc in docs:
+        assert doc.vector.sum() != 0.0, doc
+    return save(wordlists, [bestvector(doc) for doc in docs])
+
+
+def load(wordlists):
+    filename = cachefile(wordlists)
+    if os.path.exists(filename):
+        m = np.load(filename, mmap_mode='r')
+    else:
+        m = build(wordlists)
+    matrices = {}
+    start = 0
+    for form, words in wordlists:
+        matrices[form] = np.asarray(m[start:start + len(words)])
+        start += len(words)
+    assert start == len(m), filename
+    return matrices
+
+
+if __name__ == '__main__':
+    wordlists = load_wordlists()
+    build(wordlists)
+    print(cachefile(wordlists))